@@ -1,61 +1,279 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
-import math
+import atexit
+import functools
+import os
 import re
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+import lxml.etree
+import lxml.html
+import requests_cache
+
+try:
+    import polars as pl
+except ImportError:  # polars is optional; pandas handles the aggregation
+    pl = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; the kernels run as plain Python
+    def njit(*args, **kwargs):
+        def wrap(func):
+            return func
+        return wrap
+
+    prange = range
+
+# Route eligible pandas expressions through numexpr's fused, SIMD
+# evaluator; pandas ignores this where numexpr is unavailable. Matters
+# once frames grow past the per-season ~600 rows (e.g. multi-season
+# leaderboards).
+pd.set_option("compute.use_numexpr", True)
+
+# HTTP-level cache on disk so reruns and restarts don't re-download
+# basketball-reference pages. st.cache_data still memoizes the parsed
+# DataFrames in-process on top of this.
+SESSION = requests_cache.CachedSession(
+    "bbref_cache.sqlite", expire_after=86400, allowable_codes=(200,)
+)
+# Session-level headers: keep-alive amortizes the TLS handshake across the
+# per-poss + advanced fetches, and gzip cuts the HTML wire size ~5x.
+SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0",
+    "Accept-Encoding": "gzip, deflate",
+})
+
+# Two long-lived pools, split by nesting level: EXEC runs the top-level
+# fan-out (two-player scoring), FETCH_EXEC runs the page fetches those
+# tasks block on. Keeping them separate matters - a task that submits
+# work to its own bounded pool and waits on the result can deadlock once
+# every worker is a blocking parent, which two seasons on a small host
+# would trigger.
+EXEC = ThreadPoolExecutor(
+    max_workers=min(8, max(2, os.cpu_count() or 2)),
+    thread_name_prefix="bbref",
+)
+atexit.register(EXEC.shutdown)
+FETCH_EXEC = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bbref-fetch")
+atexit.register(FETCH_EXEC.shutdown)
+
+# Disk tier for merged season frames (Parquet survives process restarts).
+CACHE_DIR = Path("cache")
+
+# Stats the TAR formula compares against positional league averages.
+STAT_COLS = ["TS%", "PTS", "AST", "ORB", "DRB", "TOV", "STL", "BLK",
+             "DRtg", "MP", "3PAr", "FTr"]
+
+# Columns each page actually contributes to the TAR pipeline; everything
+# else is dropped right after parsing so the merge and groupby stay narrow.
+POSS_KEEP = ["Player", "Pos", "Tm", "MP", "PTS", "AST", "ORB", "DRB",
+             "TOV", "STL", "BLK", "DRtg"]
+ADV_KEEP = ["Player", "Pos", "Tm", "MP", "TS%", "DRtg", "3PAr", "FTr"]
+
+# Position buckets as small ints indexing the ADR weight rows:
+# 0 = guard, 1 = wing, 2 = big (also the fallback for combo listings).
+POS_CODE = {"PG": 0, "SG": 0, "SF": 1, "PF": 2, "C": 2}
+
+# Per-bucket ADR weights in factor order (drtg, drb, stl, blk), with each
+# bucket's rating bounds alongside, so the kernel selects a row by
+# pos_code instead of branching on position strings.
+ADR_WEIGHTS = np.array([
+    [0.45, 0.15, 0.35, 0.05],   # guards
+    [0.40, 0.25, 0.20, 0.15],   # wings
+    [0.35, 0.30, 0.10, 0.25],   # bigs
+], dtype=np.float32)
+ADR_FLOOR = np.array([0.0, 0.0, 0.95], dtype=np.float32)  # big-man floor
+ADR_CEIL = np.array([1.05, np.inf, np.inf], dtype=np.float32)  # guard ceiling
+
+# Stats whose factor is simply player / positional average, computed as
+# one vectorized divide. TOV and DRtg invert (lower is better) and are
+# handled separately.
+RATIO_COLS = ["TS%", "PTS", "AST", "ORB", "DRB", "STL", "BLK",
+              "MP", "3PAr", "FTr"]
 
 # -----------------------------
 # Helper functions
 # -----------------------------
+_NAME_RE = re.compile(r'[^A-Za-z]')
+
+@functools.lru_cache(maxsize=8192)
 def clean_player_name(name):
-    return re.sub(r'[^A-Za-z]', '', str(name)).lower()
+    return _NAME_RE.sub('', str(name)).lower()
 
-def league_avg(series):
-    return series.mean(skipna=True)
+def dedupe_players(df):
+    # Traded players appear once per team plus a TOT row; keep a single
+    # row per player, preferring the season total.
+    if "Tm" in df.columns:
+        df = df.sort_values("Tm", key=lambda s: s != "TOT", kind="stable")
+    return df.drop_duplicates("Player_clean", keep="first")
 
 def clean_dataframe(df):
     if isinstance(df.columns, pd.MultiIndex):
         df.columns = ['_'.join(filter(None, map(str, col))).strip() for col in df.columns]
-    df.columns = df.columns.str.strip().str.replace('\n', '', regex=False)
+    # Tiny index: a plain list-comp beats two chained .str ops that each
+    # allocate a new Index.
+    df.columns = [str(c).strip().replace('\n', '') for c in df.columns]
     return df
 
 # -----------------------------
 # Data fetching
 # -----------------------------
-@st.cache_data(show_spinner=False)
+def fetch_table(url, table_id):
+    # Parse only the one table we need instead of letting read_html
+    # build a DataFrame for every table on the page.
+    resp = SESSION.get(url, timeout=30)
+    resp.raise_for_status()
+    root = lxml.html.fromstring(resp.text)
+    # Drop the repeated/spanning header rows before pandas sees the
+    # table, so read_html yields a flat single-level header and no
+    # mid-table "Player" sentinel rows to filter out later.
+    for tr in root.xpath('//tr[contains(@class, "over_header") or contains(@class, "thead")]'):
+        tr.getparent().remove(tr)
+    tables = root.xpath(f'//table[@id="{table_id}"]')
+    if not tables:  # id drifted on the source page; fall back to the stats table
+        tables = root.xpath('//table[.//th[text()="Player"]]') or root.xpath('//table')
+    if not tables:  # e.g. stats that don't exist for the requested season
+        raise ValueError(f"No stats table found at {url}")
+    table_html = lxml.etree.tostring(tables[0])
+    return pd.read_html(StringIO(table_html.decode()), flavor="lxml")[0]
+
+@st.cache_data(show_spinner=False, ttl=86400)
 def get_season_stats(year):
     url = f"https://www.basketball-reference.com/leagues/NBA_{year}_per_poss.html"
-    df = pd.read_html(url)[0]
+    df = fetch_table(url, "per_poss_stats")
     df = clean_dataframe(df)
-    df = df[df["Player"] != "Player"]
+    df = df[df["Player"].to_numpy() != "Player"]
+    df = df[[c for c in POSS_KEEP if c in df.columns]]
 
     non_numeric = ["Player", "Pos", "Tm"]
     numeric_cols = df.columns.drop([c for c in non_numeric if c in df.columns])
-    df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors="coerce")
+    # Explicit per-column coercion fused with the downcast: no apply
+    # dispatch, and float32 is plenty for box-score rates while halving
+    # the bytes every downstream mean/mask has to move.
+    for c in numeric_cols:
+        df[c] = pd.to_numeric(df[c], errors="coerce", downcast="float")
+    # Low-cardinality labels as categories: smaller cached frames, and
+    # the groupby stays safe because it passes observed=True.
+    for c in ("Pos", "Tm"):
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    # Merge key, built here so it's cached alongside the frame: one
+    # C-level regex pass per column instead of a Python call per row.
+    df["Player_clean"] = (
+        df["Player"].astype(str).str.replace(r"[^A-Za-z]", "", regex=True).str.lower()
+    )
     return df
 
-@st.cache_data(show_spinner=False)
+@st.cache_data(show_spinner=False, ttl=86400)
 def get_advanced_stats(year):
     url = f"https://www.basketball-reference.com/leagues/NBA_{year}_advanced.html"
-    df = pd.read_html(url)[0]
+    df = fetch_table(url, "advanced_stats")
     df = clean_dataframe(df)
-    df = df[df["Player"] != "Player"]
+    df = df[df["Player"].to_numpy() != "Player"]
+    df = df[[c for c in ADV_KEEP if c in df.columns]]
 
     non_numeric = ["Player", "Pos", "Tm"]
     numeric_cols = df.columns.drop([c for c in non_numeric if c in df.columns])
-    df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors="coerce")
+    # Explicit per-column coercion fused with the downcast: no apply
+    # dispatch, and float32 is plenty for box-score rates while halving
+    # the bytes every downstream mean/mask has to move.
+    for c in numeric_cols:
+        df[c] = pd.to_numeric(df[c], errors="coerce", downcast="float")
+    # Low-cardinality labels as categories: smaller cached frames, and
+    # the groupby stays safe because it passes observed=True.
+    for c in ("Pos", "Tm"):
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    # Merge key, built here so it's cached alongside the frame: one
+    # C-level regex pass per column instead of a Python call per row.
+    df["Player_clean"] = (
+        df["Player"].astype(str).str.replace(r"[^A-Za-z]", "", regex=True).str.lower()
+    )
     return df
 
 # -----------------------------
 # TAR Calculation
 # -----------------------------
-def calculate_tar(player, year):
-    poss = get_season_stats(year)
-    adv = get_advanced_stats(year)
+@njit(cache=True, fastmath=True)
+def _tar_kernel(ts_f, sc_f, cr_f, orb_f, tov_f,
+                drtg_ratio, drb_ratio, stl_ratio, blk_ratio,
+                mp_ratio, shoot_ratio, pos_code):
+    """Pure-float TAR arithmetic, JIT-compiled so a future leaderboard
+    mode can run it per player at near-C speed; numba freezes the
+    module-level weight tables as compile-time constants."""
+    shooting_factor = max(0.75, min(shoot_ratio, 1.5)) ** 0.5
 
-    poss["Player_clean"] = poss["Player"].apply(clean_player_name)
-    adv["Player_clean"] = adv["Player"].apply(clean_player_name)
+    AOR = (
+        0.28 * ts_f +
+        0.28 * sc_f +
+        0.22 * cr_f +
+        0.12 * tov_f +
+        0.10 * orb_f
+    ) * shooting_factor
 
-    df = poss.merge(adv, on="Player_clean", how="left", suffixes=("_poss", "_adv"))
+    drtg_factor = drtg_ratio ** 0.5
+    drb_factor = min(drb_ratio, 1.6)
+    stl_factor = min(stl_ratio, 1.6)
+    blk_factor = min(blk_ratio, 1.6)
+
+    ADR = (
+        ADR_WEIGHTS[pos_code, 0] * drtg_factor +
+        ADR_WEIGHTS[pos_code, 1] * drb_factor +
+        ADR_WEIGHTS[pos_code, 2] * stl_factor +
+        ADR_WEIGHTS[pos_code, 3] * blk_factor
+    )
+    ADR = min(max(ADR, ADR_FLOOR[pos_code]), ADR_CEIL[pos_code])
+
+    minute_factor = min(1.0, mp_ratio)
+    TAR = AOR * ADR * minute_factor
+    return AOR, ADR, TAR, shooting_factor
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _tar_kernel_batch(ratios, tov_factors, drtg_ratios, pos_codes):
+    """Score many players at once: `ratios` is (n_players, 10) float32 in
+    RATIO_COLS order. Multi-core via prange; reuses the scalar kernel."""
+    n = ratios.shape[0]
+    aor = np.empty(n, dtype=np.float32)
+    adr = np.empty(n, dtype=np.float32)
+    tar = np.empty(n, dtype=np.float32)
+    for i in prange(n):
+        a, d, t, _ = _tar_kernel(
+            ratios[i, 0], ratios[i, 1], ratios[i, 2], ratios[i, 3],
+            tov_factors[i], drtg_ratios[i],
+            ratios[i, 4], ratios[i, 5], ratios[i, 6],
+            ratios[i, 7], ratios[i, 8] * ratios[i, 9],
+            pos_codes[i],
+        )
+        aor[i] = a
+        adr[i] = d
+        tar[i] = t
+    return aor, adr, tar
+
+def _fetch_merged(year):
+    """Fetch both pages and produce the merged, renamed season frame."""
+    f_poss = FETCH_EXEC.submit(get_season_stats, year)
+    f_adv = FETCH_EXEC.submit(get_advanced_stats, year)
+    poss = f_poss.result()
+    adv = f_adv.result()
+
+    # Push the row filter ahead of the join: players with no minutes
+    # contribute nothing downstream, and stray header rows parse as NaN.
+    poss = poss[poss["MP"].notna() & (poss["MP"] > 0)]
+    if "MP" in adv.columns:
+        adv = adv[adv["MP"].notna() & (adv["MP"] > 0)]
+
+    poss = dedupe_players(poss)
+    adv = dedupe_players(adv)
+
+    # validate catches an accidental many-to-many blowup if the key ever
+    # stops being unique.
+    df = poss.merge(adv, on="Player_clean", how="left",
+                    validate="one_to_one", suffixes=("_poss", "_adv"))
 
     rename_map = {
         "MP_poss": "MP",
@@ -73,97 +291,152 @@ def calculate_tar(player, year):
         "Pos_poss": "Pos"
     }
     df.rename(columns=rename_map, inplace=True)
+    return df
+
+@st.cache_data(show_spinner=False, ttl=86400)
+def build_season_frame(year):
+    """Merge and aggregate one season; cached in-process and mirrored to
+    Parquet so a process restart rereads columnar disk data instead of
+    refetching and reparsing HTML."""
+    path = CACHE_DIR / f"NBA_{year}_merged.parquet"
+    if path.exists() and time.time() - path.stat().st_mtime < 86400:
+        df = pd.read_parquet(path)
+    else:
+        df = _fetch_merged(year)
+        try:
+            CACHE_DIR.mkdir(exist_ok=True)
+            df.to_parquet(path, compression="zstd")
+        except OSError:  # read-only deployments just skip the disk tier
+            pass
+
+    # League averages by position: one grouped pass over the stat
+    # columns instead of twelve boolean-masked means. polars' threaded
+    # group_by takes over when available.
+    if pl is not None:
+        pos_means = (
+            pl.from_pandas(df[["Pos"] + STAT_COLS])
+            .group_by("Pos")
+            .agg([pl.col(c).mean() for c in STAT_COLS])
+            .to_pandas()
+            .set_index("Pos")
+        )
+    else:
+        pos_means = df.groupby("Pos", observed=True, sort=False)[STAT_COLS].mean()
+
+    # Hash-indexed lookup instead of scanning Player_clean per query.
+    df = df.set_index("Player_clean", drop=False)
+    return df, pos_means
+
+def prefetch(years):
+    # Warm the per-year caches up front; the set collapses duplicate
+    # years so comparing two players from one season builds it once.
+    # A short-lived local pool keeps this fan-out off the shared
+    # executors entirely, so it can never starve (or be starved by)
+    # tasks already running on them.
+    years = set(years)
+    with ThreadPoolExecutor(max_workers=max(1, len(years))) as ex:
+        list(ex.map(build_season_frame, years))
+
+def calculate_tar(player, year):
+    df, pos_means = build_season_frame(year)
 
     player_clean = clean_player_name(player)
-    if player_clean not in df["Player_clean"].values:
-        raise ValueError(f"Player '{player}' not found for {year}")
-
-    p = df[df["Player_clean"] == player_clean].iloc[0]
-
-    pos_filter = df["Pos"] == p["Pos"]
-
-    # League averages by position
-    ts_avg = league_avg(df[pos_filter]["TS%"])
-    pts_avg = league_avg(df[pos_filter]["PTS"])
-    ast_avg = league_avg(df[pos_filter]["AST"])
-    orb_avg = league_avg(df[pos_filter]["ORB"])
-    tov_avg = league_avg(df[pos_filter]["TOV"])
-    drb_avg = league_avg(df[pos_filter]["DRB"])
-    stl_avg = league_avg(df[pos_filter]["STL"])
-    blk_avg = league_avg(df[pos_filter]["BLK"])
-    mp_avg = league_avg(df[pos_filter]["MP"])
-    drtg_avg = league_avg(df[pos_filter]["DRtg"])
-    threepar_avg = league_avg(df[pos_filter]["3PAr"])
-    ftr_avg = league_avg(df[pos_filter]["FTr"])
-
-    # -----------------------------
-    # OFFENSE (AOR)
-    # -----------------------------
-    ts_factor = p["TS%"] / ts_avg
-    scoring_factor = p["PTS"] / pts_avg
-    creation_factor = p["AST"] / ast_avg
-    orb_factor = p["ORB"] / orb_avg
-    tov_factor = tov_avg / p["TOV"] if p["TOV"] > 0 else 1
-
-    shooting_factor = math.sqrt(
-        max(0.75, min((p["3PAr"] / threepar_avg) * (p["FTr"] / ftr_avg), 1.5))
+    try:
+        p = df.loc[player_clean]
+    except KeyError:
+        # The aggressive cleaner can mangle accented or suffixed names;
+        # fall back to a case-insensitive match on the raw listing
+        # before giving up. Only this cold path pays the column scan.
+        name_col = "Player_poss" if "Player_poss" in df.columns else "Player"
+        mask = df[name_col].astype(str).str.casefold().eq(player.strip().casefold())
+        if not mask.any():
+            raise ValueError(f"Player '{player}' not found for {year}")
+        p = df[mask].iloc[0]
+    if isinstance(p, pd.DataFrame):  # duplicate entries (e.g. traded players)
+        p = p.iloc[0]
+    # Plain dict: the dozen p[...] reads below skip Series label
+    # resolution per access.
+    p = p.to_dict()
+
+    avgs = pos_means.loc[p["Pos"]]
+
+    # One vectorized divide for every player-over-average factor; the
+    # clamping and weighting happen inside the JIT kernel.
+    num = np.array([p[c] for c in RATIO_COLS], dtype=np.float32)
+    den = avgs[RATIO_COLS].to_numpy(dtype=np.float32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f = num / den
+    # Neutral factor wherever a stat or its average is zero/missing.
+    f = np.where(np.isfinite(f), f, np.float32(1.0))
+    ts_f, sc_f, cr_f, orb_f, drb_f, stl_f, blk_f, mp_f, threepar_f, ftr_f = f
+
+    # Lower-is-better stats invert against the average.
+    tov_factor = avgs["TOV"] / p["TOV"] if p["TOV"] > 0 else 1.0
+    drtg_ratio = avgs["DRtg"] / p["DRtg"] if p["DRtg"] > 0 else 1.0
+
+    AOR, ADR, TAR, shooting_factor = _tar_kernel(
+        float(ts_f),
+        float(sc_f),
+        float(cr_f),
+        float(orb_f),
+        float(tov_factor),
+        float(drtg_ratio),
+        float(drb_f),
+        float(stl_f),
+        float(blk_f),
+        float(mp_f),
+        float(threepar_f * ftr_f),
+        POS_CODE.get(p["Pos"], 2),
     )
 
-    AOR = (
-        0.28 * ts_factor +
-        0.28 * scoring_factor +
-        0.22 * creation_factor +
-        0.12 * tov_factor +
-        0.10 * orb_factor
-    ) * shooting_factor
-
-    # -----------------------------
-    # DEFENSE (ADR)
-    # -----------------------------
-    # Team-relative DRtg correction
-    drtg_factor = math.sqrt(drtg_avg / p["DRtg"])
-    drb_factor = min(p["DRB"] / drb_avg, 1.6)
-    stl_factor = min(p["STL"] / stl_avg, 1.6)
-    blk_factor = min(p["BLK"] / blk_avg, 1.6)
-
-    pos = p["Pos"]
-
-    if pos in ["PG", "SG"]:
-        ADR = (
-            0.45 * drtg_factor +
-            0.35 * stl_factor +
-            0.15 * drb_factor +
-            0.05 * blk_factor
+    # A typed Series renders directly in Streamlit without the
+    # dict-to-table conversion step.
+    return pd.Series(
+        {
+            "AOR": AOR,
+            "ADR": ADR,
+            "TAR": TAR,
+            "MP": p["MP"],
+            "ShootingFactor": shooting_factor,
+        },
+        dtype=np.float32,
+    ).round(3)
+
+@st.cache_data(show_spinner=False, ttl=86400)
+def calculate_tar_season(year):
+    """Score every player in a season in one batched kernel call;
+    backs leaderboard-style views."""
+    df, pos_means = build_season_frame(year)
+    df = df[df["Pos"].notna()]
+
+    avg_rows = pos_means.loc[df["Pos"]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = df[RATIO_COLS].to_numpy(dtype=np.float32) / \
+            avg_rows[RATIO_COLS].to_numpy(dtype=np.float32)
+    ratios = np.where(np.isfinite(ratios), ratios, np.float32(1.0))
+
+    tov = df["TOV"].to_numpy(dtype=np.float32)
+    tov_factors = np.where(
+        tov > 0, avg_rows["TOV"].to_numpy(dtype=np.float32) / tov, np.float32(1.0)
+    ).astype(np.float32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        drtg_ratios = (
+            avg_rows["DRtg"].to_numpy(dtype=np.float32)
+            / df["DRtg"].to_numpy(dtype=np.float32)
         )
-        ADR = min(ADR, 1.05)  # guard ceiling
-    elif pos == "SF":
-        ADR = (
-            0.40 * drtg_factor +
-            0.25 * drb_factor +
-            0.20 * stl_factor +
-            0.15 * blk_factor
-        )
-    else:
-        ADR = (
-            0.35 * drtg_factor +
-            0.30 * drb_factor +
-            0.10 * stl_factor +
-            0.25 * blk_factor
-        )
-        ADR = max(ADR, 0.95)  # big-man floor
+    drtg_ratios = np.where(
+        np.isfinite(drtg_ratios), drtg_ratios, np.float32(1.0)
+    ).astype(np.float32)
+    pos_codes = np.array([POS_CODE.get(x, 2) for x in df["Pos"]], dtype=np.int64)
 
-    # Minutes factor
-    minute_factor = min(1.0, p["MP"] / mp_avg)
+    aor, adr, tar = _tar_kernel_batch(ratios, tov_factors, drtg_ratios, pos_codes)
 
-    TAR = AOR * ADR * minute_factor
-
-    return {
-        "AOR": round(AOR, 3),
-        "ADR": round(ADR, 3),
-        "TAR": round(TAR, 3),
-        "MP": round(p["MP"], 1),
-        "ShootingFactor": round(shooting_factor, 3)
-    }
+    name_col = "Player_poss" if "Player_poss" in df.columns else "Player"
+    out = pd.DataFrame(
+        {"Player": df[name_col].to_numpy(), "Pos": df["Pos"].to_numpy(),
+         "AOR": aor, "ADR": adr, "TAR": tar}
+    )
+    return out.sort_values("TAR", ascending=False, ignore_index=True).round(3)
 
 # -----------------------------
 # Streamlit UI
@@ -197,8 +470,11 @@ with col2:
 
 if st.button("Compare"):
     try:
-        r1 = calculate_tar(player_a, year_a)
-        r2 = calculate_tar(player_b, year_b)
+        prefetch((year_a, year_b))
+        f1 = EXEC.submit(calculate_tar, player_a, year_a)
+        f2 = EXEC.submit(calculate_tar, player_b, year_b)
+        r1 = f1.result()
+        r2 = f2.result()
 
         st.divider()
         c1, c2 = st.columns(2)